@@ -19,11 +19,20 @@ STREAM_KEY  = "whatsapp:messages"
 # ── Redis ─────────────────────────────────────────────────────────────────────
 redis_client: aioredis.Redis | None = None
 
+# ── Baileys HTTP client (pooled, keep-alive) ──────────────────────────────────
+http_client: httpx.AsyncClient | None = None
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    global redis_client
+    global redis_client, http_client
     redis_client = aioredis.from_url(REDIS_URL, encoding="utf-8", decode_responses=True)
+    http_client = httpx.AsyncClient(
+        base_url=BAILEYS_URL,
+        timeout=httpx.Timeout(30.0),
+        limits=httpx.Limits(max_keepalive_connections=50, max_connections=100, keepalive_expiry=60.0),
+    )
     yield
+    await http_client.aclose()
     await redis_client.aclose()
 
 # ── Models ────────────────────────────────────────────────────────────────────
@@ -67,22 +76,19 @@ class WebhookUnregister(BaseModel):
 
 # ── Helpers ───────────────────────────────────────────────────────────────────
 async def baileys_post(path: str, data: dict) -> dict:
-    async with httpx.AsyncClient(timeout=30) as c:
-        r = await c.post(f"{BAILEYS_URL}{path}", json=data)
-        r.raise_for_status()
-        return r.json()
+    r = await http_client.post(path, json=data)
+    r.raise_for_status()
+    return r.json()
 
 async def baileys_get(path: str) -> dict:
-    async with httpx.AsyncClient(timeout=10) as c:
-        r = await c.get(f"{BAILEYS_URL}{path}")
-        r.raise_for_status()
-        return r.json()
+    r = await http_client.get(path, timeout=10)
+    r.raise_for_status()
+    return r.json()
 
 async def baileys_delete(path: str, data: dict = None) -> dict:
-    async with httpx.AsyncClient(timeout=10) as c:
-        r = await c.delete(f"{BAILEYS_URL}{path}", json=data) if data else await c.delete(f"{BAILEYS_URL}{path}")
-        r.raise_for_status()
-        return r.json()
+    r = await http_client.request("DELETE", path, json=data, timeout=10)
+    r.raise_for_status()
+    return r.json()
 
 # ── App ───────────────────────────────────────────────────────────────────────
 app = FastAPI(
@@ -1,59 +1,98 @@
+import asyncio
 import base64
 import io
 import sys
 import os
+import re
 from contextlib import asynccontextmanager
+from functools import lru_cache
 from typing import Optional, List
 
 import httpx
+import orjson
+from cachetools import TTLCache
 import qrcode
 import redis.asyncio as aioredis
 from fastapi import FastAPI, HTTPException, Query, Request
-from fastapi.responses import StreamingResponse
-from pydantic import BaseModel, Field
+from fastapi.responses import ORJSONResponse, Response
+from pydantic import BaseModel, ConfigDict, Field
 
 sys.path.insert(0, os.path.dirname(__file__))
 
 # ── Config ────────────────────────────────────────────────────────────────────
-BAILEYS_URL = "http://localhost:3001"
+BAILEYS_URL = os.getenv("BAILEYS_URL", "http://localhost:3001")
+# HTTP/2 נבחר רק דרך ALPN ב-TLS — רלוונטי כש-Baileys מאחורי https (Express עצמו מדבר HTTP/1.1)
+BAILEYS_HTTP2 = os.getenv("BAILEYS_HTTP2", "0") == "1"
 REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379")
+STREAM_KEY = os.getenv("REDIS_STREAM_KEY", "whatsapp:messages")
+STREAM_GROUP = "api-consumers"
 
 # ── Redis ─────────────────────────────────────────────────────────────────────
 redis_client: aioredis.Redis | None = None
 
+# ── Baileys HTTP client (pooled, keep-alive) ──────────────────────────────────
+http_client: httpx.AsyncClient | None = None
+
+# ── Webhook HTTP client (webhooks חיצוניים) ──────────────────────────────────
+webhook_client: httpx.AsyncClient | None = None
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    global redis_client
-    redis_client = aioredis.from_url(REDIS_URL, encoding="utf-8", decode_responses=True)
+    global redis_client, http_client, webhook_client
+    pool = aioredis.ConnectionPool.from_url(
+        REDIS_URL,
+        encoding="utf-8",
+        decode_responses=True,
+        max_connections=128,
+        socket_keepalive=True,
+        health_check_interval=30,
+        retry_on_timeout=True,
+    )
+    redis_client = aioredis.Redis(connection_pool=pool)
+    http_client = httpx.AsyncClient(
+        base_url=BAILEYS_URL,
+        http2=BAILEYS_HTTP2,
+        timeout=httpx.Timeout(30.0),
+        limits=httpx.Limits(max_keepalive_connections=50, max_connections=100, keepalive_expiry=60.0),
+    )
+    webhook_client = httpx.AsyncClient(timeout=10)
     app.state.redis = redis_client
+    app.state.trace_jid = redis_client.register_script(TRACE_JID_LUA)
     yield
-    await redis_client.aclose()
+    await flush_webhook_batches()
+    await webhook_client.aclose()
+    await http_client.aclose()
+    await redis_client.aclose(close_connection_pool=True)
 
 # ── Models ────────────────────────────────────────────────────────────────────
-class TextMsg(BaseModel):
+class FrozenModel(BaseModel):
+    """גוף בקשה — לא משתנה אחרי ולידציה."""
+    model_config = ConfigDict(frozen=True)
+
+class TextMsg(FrozenModel):
     jid: str
     text: str
 
-class ButtonItem(BaseModel):
+class ButtonItem(FrozenModel):
     id: str
     text: str
 
-class ButtonMsg(BaseModel):
+class ButtonMsg(FrozenModel):
     jid: str
     text: str
     footer: Optional[str] = None
     buttons: List[ButtonItem] = Field(..., min_length=1, max_length=3)
 
-class ListRow(BaseModel):
+class ListRow(FrozenModel):
     id: str
     title: str
     description: Optional[str] = None
 
-class ListSection(BaseModel):
+class ListSection(FrozenModel):
     title: str
     rows: List[ListRow]
 
-class ListMsg(BaseModel):
+class ListMsg(FrozenModel):
     jid: str
     text: str
     title: Optional[str] = None
@@ -61,59 +100,234 @@ class ListMsg(BaseModel):
     footer: Optional[str] = None
     sections: List[ListSection]
 
-class WebhookRegister(BaseModel):
+class WebhookRegister(FrozenModel):
     url: str
     secret: Optional[str] = None
 
-class WebhookUnregister(BaseModel):
+class WebhookRegisterBatched(WebhookRegister):
+    batchSize: int       = Field(50, ge=1, le=500)
+    batchIntervalMs: int = Field(200, ge=10, le=60000)
+
+class WebhookUnregister(FrozenModel):
     url: str
 
-class ButtonResponse(BaseModel):
+class ButtonResponse(FrozenModel):
     jid: str
     buttonId: str
     displayText: str
 
-class ListResponse(BaseModel):
+class ListResponse(FrozenModel):
     jid: str
     rowId: str
     title: Optional[str] = None
 
+class StreamAck(FrozenModel):
+    ids: List[str] = Field(..., min_length=1)
+
 # ── Helpers ───────────────────────────────────────────────────────────────────
+def _baileys_json(r: httpx.Response) -> dict:
+    """raise_for_status + פענוח התשובה; גוף שאינו JSON (proxy / crash של Baileys) → 503"""
+    r.raise_for_status()
+    try:
+        return orjson.loads(r.content)
+    except orjson.JSONDecodeError as e:
+        raise HTTPException(503, f"Baileys returned invalid JSON: {e}")
+
 async def baileys_post(path: str, data: dict) -> dict:
-    async with httpx.AsyncClient(timeout=30) as c:
-        r = await c.post(f"{BAILEYS_URL}{path}", json=data)
-        r.raise_for_status()
-        return r.json()
+    r = await http_client.post(path, json=data)
+    return _baileys_json(r)
+
+async def baileys_post_raw(path: str, payload: bytes) -> dict:
+    """כמו baileys_post, אבל עם JSON מוכן (bytes) — בלי dict ובלי json.dumps."""
+    r = await http_client.post(path, content=payload, headers={"content-type": "application/json"})
+    return _baileys_json(r)
 
-async def baileys_get(path: str) -> dict:
-    async with httpx.AsyncClient(timeout=10) as c:
-        r = await c.get(f"{BAILEYS_URL}{path}")
-        r.raise_for_status()
-        return r.json()
+async def baileys_get(path: str, params: dict | None = None) -> dict:
+    r = await http_client.get(path, params=params, timeout=10)
+    return _baileys_json(r)
 
 async def baileys_delete(path: str, data: dict = None) -> dict:
-    async with httpx.AsyncClient(timeout=10) as c:
-        r = await c.delete(f"{BAILEYS_URL}{path}", json=data) if data else await c.delete(f"{BAILEYS_URL}{path}")
-        r.raise_for_status()
-        return r.json()
+    r = await http_client.request("DELETE", path, json=data, timeout=10)
+    return _baileys_json(r)
+
+# cache קצר ל-GETs שנשאלים הרבה (dashboards / probes) — N pollers במקביל → קריאה אחת ל-Baileys
+_get_cache: TTLCache = TTLCache(maxsize=16, ttl=0.5)
+_get_inflight: dict[str, asyncio.Task] = {}
+
+async def _fetch_and_cache(path: str) -> dict:
+    try:
+        result = await baileys_get(path)
+        _get_cache[path] = result
+        return result
+    finally:
+        _get_inflight.pop(path, None)
+
+async def cached_get(path: str) -> dict:
+    """baileys_get עם TTL cache ו-single-flight לכל path.
+
+    כל הקוראים במקביל מחכים לאותה קריאה — גם כשהיא נכשלת (כולם מקבלים את השגיאה).
+    """
+    # get() יחיד — בין `in` ל-[] ה-entry יכול לפוג ולזרוק KeyError
+    cached = _get_cache.get(path)
+    if cached is not None:
+        return cached
+    task = _get_inflight.get(path)
+    if task is None:
+        task = _get_inflight[path] = asyncio.create_task(_fetch_and_cache(path))
+    # shield — קורא שבוטל לא מבטל את הקריאה המשותפת לשאר
+    return await asyncio.shield(task)
+
+def _stream_entry(eid: str, fields: dict | None) -> dict | None:
+    """ממיר entry מה-Stream ({"data": "<json>"}) ל-dict עם id — כמו ב-Baileys."""
+    # entry pending שנמחק מה-Stream (XDEL/MAXLEN) חוזר מ-XREADGROUP בלי fields
+    if not fields:
+        return None
+    try:
+        data = orjson.loads(fields["data"])
+    except (KeyError, orjson.JSONDecodeError):
+        return None
+    return {"id": eid, **data} if isinstance(data, dict) else None
+
+# סורק את ה-Stream מהחדש לישן, מסנן לפי jid/sender ומחזיר מערך JSON אחד.
+# ה-data של כל entry משורשר כמו שהוא (עם id בהתחלה) — בלי encode מחדש ב-Lua.
+TRACE_JID_LUA = """
+local jid, limit = ARGV[1], tonumber(ARGV[2])
+local entries = redis.call('XREVRANGE', KEYS[1], '+', '-', 'COUNT', limit * 3)
+local out = {}
+for _, e in ipairs(entries) do
+  local fields, data = e[2], nil
+  for i = 1, #fields, 2 do
+    if fields[i] == 'data' then data = fields[i + 1] end
+  end
+  if data then
+    local ok, msg = pcall(cjson.decode, data)
+    if ok and type(msg) == 'table' and (msg.jid == jid or msg.sender == jid) then
+      local body = string.match(data, '^%s*{%s*(.*)$')
+      if body then
+        local head = '{"id":"' .. e[1] .. '"'
+        if string.sub(body, 1, 1) == '}' then
+          out[#out + 1] = head .. '}'
+        else
+          out[#out + 1] = head .. ',' .. body
+        end
+        if #out >= limit then break end
+      end
+    end
+  end
+end
+return '[' .. table.concat(out, ',') .. ']'
+"""
+
+def _normalize_jid(jid: str) -> str:
+    return jid if "@" in jid else re.sub(r"\D", "", jid) + "@s.whatsapp.net"
+
+_QR = qrcode.QRCode(
+    version=None,
+    error_correction=qrcode.constants.ERROR_CORRECT_L,
+    box_size=6,
+    border=2,
+)
+
+@lru_cache(maxsize=4)
+def _render_qr_png(data: str) -> bytes:
+    """מרנדר QR ל-PNG — ה-QR זהה בין polls, אז התוצאה נשמרת ב-cache."""
+    _QR.clear()
+    _QR.version = None  # best_fit מתחיל מהגרסה הקודמת — מאפסים כדי לא לנפח QR קטן
+    _QR.add_data(data)
+    _QR.make(fit=True)
+    img = _QR.make_image()
+    buf = io.BytesIO()
+    img.save(buf, "PNG", optimize=False, compress_level=1)  # QR דחוס ממילא — zlib 6 מבזבז CPU
+    return buf.getvalue()
+
+@lru_cache(maxsize=4)
+def _render_qr_b64(data: str) -> str:
+    """ה-PNG של ה-QR כ-base64 — גם הקידוד נשמר ב-cache, לא רק הרינדור."""
+    return base64.b64encode(_render_qr_png(data)).decode()
+
+def _webhook_headers(wh: dict) -> dict:
+    headers = {"Content-Type": "application/json"}
+    if wh.get("secret"):
+        headers["X-Webhook-Secret"] = wh["secret"]
+    return headers
+
+# ── Webhook batching ──────────────────────────────────────────────────────────
+# webhook שנרשם עם batchSize מקבל מערך של אירועים במקום אירוע בודד:
+# נשלח כשהבאפר מתמלא או כשעובר batchIntervalMs מהאירוע הראשון בו.
+_webhook_batches: dict[str, tuple[dict, list]] = {}
+_webhook_timers: dict[str, asyncio.Task] = {}
+_webhook_sends: set[asyncio.Task] = set()
+
+async def _post_batch(wh: dict, events: list) -> None:
+    try:
+        await webhook_client.post(wh["url"], json=events, headers=_webhook_headers(wh))
+    except Exception:
+        pass
+
+def _send_batch_in_background(wh: dict, events: list) -> None:
+    # לא מחכים ל-POST — שלא יעכב webhooks אחרים ואת התשובה ל-Baileys
+    task = asyncio.create_task(_post_batch(wh, events))
+    _webhook_sends.add(task)
+    task.add_done_callback(_webhook_sends.discard)
+
+async def _flush_batch_later(url: str, delay: float) -> None:
+    await asyncio.sleep(delay)
+    _webhook_timers.pop(url, None)
+    wh, events = _webhook_batches.pop(url, (None, []))
+    if events:
+        # דרך _webhook_sends — כדי ש-shutdown יחכה גם לשליחה הזאת
+        _send_batch_in_background(wh, events)
+
+def _enqueue_batched(wh: dict, payload: dict) -> None:
+    url = wh["url"]
+    _, events = _webhook_batches.setdefault(url, (wh, []))
+    events.append(payload)
+    if len(events) >= wh["batchSize"]:
+        del _webhook_batches[url]
+        timer = _webhook_timers.pop(url, None)
+        if timer:
+            timer.cancel()
+        _send_batch_in_background(wh, events)
+    elif url not in _webhook_timers:
+        _webhook_timers[url] = asyncio.create_task(
+            _flush_batch_later(url, wh.get("batchIntervalMs", 200) / 1000)
+        )
+
+def _drop_webhook_batch(url: str) -> None:
+    """זורק באפר + טיימר של url (כשה-webhook הוסר או עבר למצב רגיל)."""
+    _webhook_batches.pop(url, None)
+    timer = _webhook_timers.pop(url, None)
+    if timer:
+        timer.cancel()
+
+async def flush_webhook_batches() -> None:
+    """שולח את כל מה שנשאר בבאפרים ומחכה לשליחות שבדרך (ב-shutdown)."""
+    for task in _webhook_timers.values():
+        task.cancel()
+    _webhook_timers.clear()
+    pending = list(_webhook_batches.values())
+    _webhook_batches.clear()
+    await asyncio.gather(
+        *(_post_batch(wh, events) for wh, events in pending),
+        *list(_webhook_sends),
+    )
 
 async def forward_to_webhooks(redis, payload: dict) -> None:
     """מעביר payload לכל webhooks חיצוניים רשומים ב-Redis."""
     try:
-        import json
         raw = await redis.get("wa:external_hooks")
-        webhooks = json.loads(raw) if raw else []
-        if not webhooks:
-            return
-        async with httpx.AsyncClient(timeout=10) as c:
-            for wh in webhooks:
-                try:
-                    headers = {"Content-Type": "application/json"}
-                    if wh.get("secret"):
-                        headers["X-Webhook-Secret"] = wh["secret"]
-                    await c.post(wh["url"], json=payload, headers=headers)
-                except Exception:
-                    pass
+        webhooks = orjson.loads(raw) if raw else []
+        immediate = []
+        for wh in webhooks:
+            if wh.get("batchSize"):
+                _enqueue_batched(wh, payload)
+            else:
+                immediate.append(wh)
+        for wh in immediate:
+            try:
+                await webhook_client.post(wh["url"], json=payload, headers=_webhook_headers(wh))
+            except Exception:
+                pass
     except Exception:
         pass
 
@@ -135,51 +349,47 @@ app = FastAPI(
 - **Messages**: קרא הודעות מה-stream
 - **Contacts**: רשימת אנשי קשר
 """,
-    lifespan=lifespan
+    lifespan=lifespan,
+    default_response_class=ORJSONResponse,
 )
 
+# ── Baileys errors → HTTP ─────────────────────────────────────────────────────
+@app.exception_handler(httpx.HTTPStatusError)
+async def baileys_status_error(request: Request, e: httpx.HTTPStatusError):
+    """Baileys החזיר שגיאה: 4xx עובר כמו שהוא (שגיאת לקוח), 5xx → 503"""
+    try:
+        detail = orjson.loads(e.response.content).get("error") or str(e)
+    except (orjson.JSONDecodeError, AttributeError):
+        detail = str(e)
+    code = e.response.status_code if 400 <= e.response.status_code < 500 else 503
+    return ORJSONResponse({"detail": detail}, status_code=code)
+
+@app.exception_handler(httpx.RequestError)
+async def baileys_unavailable(request: Request, e: httpx.RequestError):
+    """Baileys לא זמין (connection refused / timeout)"""
+    return ORJSONResponse({"detail": f"Baileys unavailable: {e}"}, status_code=503)
+
 # ── Connection ────────────────────────────────────────────────────────────────
 @app.get("/status", tags=["Connection"])
 async def status():
     """סטטוס החיבור ל-WhatsApp"""
-    try:
-        return await baileys_get("/status")
-    except Exception as e:
-        raise HTTPException(503, f"Baileys unavailable: {e}")
+    return ORJSONResponse(await cached_get("/status"))
 
 @app.get("/qrcode", tags=["Connection"])
 async def get_qrcode():
     """QR Code כ-JSON עם base64 תמונה"""
-    try:
-        r = await baileys_get("/qrcode")
-        img_b64 = None
-        if r.get("qr"):
-            img = qrcode.make(r["qr"])
-            buf = io.BytesIO()
-            img.save(buf, "PNG")
-            img_b64 = base64.b64encode(buf.getvalue()).decode()
-        return {"qr": r.get("qr"), "qr_image_base64": img_b64, "status": r.get("status")}
-    except httpx.HTTPStatusError:
-        raise HTTPException(404, "QR not available – check /status")
-    except Exception as e:
-        raise HTTPException(503, str(e))
+    r = await baileys_get("/qrcode")
+    img_b64 = _render_qr_b64(r["qr"]) if r.get("qr") else None
+    return {"qr": r.get("qr"), "qr_image_base64": img_b64, "status": r.get("status")}
 
 @app.get("/qrcode/image", tags=["Connection"])
 async def qrcode_image():
     """QR Code כתמונת PNG — פתח בדפדפן וסרוק"""
-    try:
-        r = await baileys_get("/qrcode")
-        if not r.get("qr"):
-            raise HTTPException(404, "QR not available")
-        img = qrcode.make(r["qr"])
-        buf = io.BytesIO()
-        img.save(buf, "PNG")
-        buf.seek(0)
-        return StreamingResponse(buf, media_type="image/png")
-    except HTTPException:
-        raise
-    except Exception as e:
-        raise HTTPException(503, str(e))
+    r = await baileys_get("/qrcode")
+    if not r.get("qr"):
+        raise HTTPException(404, "QR not available")
+    # ה-PNG כבר בזיכרון — Response רגיל שולח Content-Length במקום chunked
+    return Response(_render_qr_png(r["qr"]), media_type="image/png")
 
 @app.delete("/logout", tags=["Connection"])
 async def logout():
@@ -190,27 +400,27 @@ async def logout():
 @app.post("/send/text", tags=["Send"])
 async def send_text(b: TextMsg):
     """שלח הודעת טקסט"""
-    return await baileys_post("/send/text", b.model_dump())
+    return await baileys_post_raw("/send/text", b.__pydantic_serializer__.to_json(b))
 
 @app.post("/send/buttons", tags=["Send"])
 async def send_buttons(b: ButtonMsg):
     """שלח כפתורים (עד 3) — Business API בלבד"""
-    return await baileys_post("/send/buttons", b.model_dump())
+    return await baileys_post_raw("/send/buttons", b.__pydantic_serializer__.to_json(b))
 
 @app.post("/send/list", tags=["Send"])
 async def send_list(b: ListMsg):
     """שלח תפריט צף"""
-    return await baileys_post("/send/list", b.model_dump())
+    return await baileys_post_raw("/send/list", b.__pydantic_serializer__.to_json(b))
 
 @app.post("/send/button-response", tags=["Send"])
 async def send_button_response(b: ButtonResponse):
     """סימולציה של לחיצת כפתור"""
-    return await baileys_post("/send/button-response", b.model_dump())
+    return await baileys_post_raw("/send/button-response", b.__pydantic_serializer__.to_json(b))
 
 @app.post("/send/list-response", tags=["Send"])
 async def send_list_response(b: ListResponse):
     """סימולציה של בחירה מתפריט"""
-    return await baileys_post("/send/list-response", b.model_dump())
+    return await baileys_post_raw("/send/list-response", b.__pydantic_serializer__.to_json(b))
 
 # ── Webhooks (לקוחות חיצוניים רושמים כאן) ───────────────────────────────────
 @app.post("/webhooks/register", tags=["Webhooks"])
@@ -230,29 +440,54 @@ async def register_webhook(request: Request, b: WebhookRegister):
     }
     ```
     """
-    import json
     redis = request.app.state.redis
     raw   = await redis.get("wa:external_hooks")
-    hooks = json.loads(raw) if raw else []
+    hooks = orjson.loads(raw) if raw else []
 
-    if not any(h["url"] == b.url for h in hooks):
+    existing = next((h for h in hooks if h["url"] == b.url), None)
+    if existing is None or existing.get("batchSize"):
+        # webhook שהיה batched עובר למצב רגיל — אחרת היה מקבל גם מערכים מכאן וגם אירועים מ-Baileys
+        _drop_webhook_batch(b.url)
+        hooks = [h for h in hooks if h["url"] != b.url]
         hooks.append({"url": b.url, "secret": b.secret})
-        await redis.set("wa:external_hooks", json.dumps(hooks))
+        await redis.set("wa:external_hooks", orjson.dumps(hooks))
 
     # גם רשום ב-Baileys לקבלת הודעות
     await baileys_post("/webhooks/register", b.model_dump())
 
     return {"success": True, "url": b.url, "total": len(hooks)}
 
+@app.post("/webhooks/register_batched", tags=["Webhooks"])
+async def register_webhook_batched(request: Request, b: WebhookRegisterBatched):
+    """
+    רשום webhook שמקבל אירועים במנות (מערך JSON) במקום אירוע לכל POST.
+
+    - **batchSize**: כמה אירועים לכל היותר בכל POST (ברירת מחדל: 50)
+    - **batchIntervalMs**: זמן מקסימלי שאירוע ממתין בבאפר (ברירת מחדל: 200)
+    """
+    redis = request.app.state.redis
+    raw   = await redis.get("wa:external_hooks")
+    old   = orjson.loads(raw) if raw else []
+    hooks = [h for h in old if h["url"] != b.url]
+    hooks.append(b.model_dump())
+    await redis.set("wa:external_hooks", orjson.dumps(hooks))
+
+    # לא נרשם ב-Baileys: הוא היה שולח כל אירוע בנפרד בנוסף למערך מכאן.
+    # אם ה-url היה רשום קודם כ-webhook רגיל — מסירים אותו משם.
+    if any(h["url"] == b.url and not h.get("batchSize") for h in old):
+        await baileys_delete("/webhooks/unregister", {"url": b.url})
+
+    return {"success": True, "url": b.url, "total": len(hooks)}
+
 @app.delete("/webhooks/unregister", tags=["Webhooks"])
 async def unregister_webhook(request: Request, b: WebhookUnregister):
     """הסר webhook"""
-    import json
     redis = request.app.state.redis
     raw   = await redis.get("wa:external_hooks")
-    hooks = json.loads(raw) if raw else []
+    hooks = orjson.loads(raw) if raw else []
     hooks = [h for h in hooks if h["url"] != b.url]
-    await redis.set("wa:external_hooks", json.dumps(hooks))
+    await redis.set("wa:external_hooks", orjson.dumps(hooks))
+    _drop_webhook_batch(b.url)
 
     await baileys_delete("/webhooks/unregister", b.model_dump())
     return {"success": True, "total": len(hooks)}
@@ -260,10 +495,9 @@ async def unregister_webhook(request: Request, b: WebhookUnregister):
 @app.get("/webhooks", tags=["Webhooks"])
 async def list_webhooks(request: Request):
     """רשימת webhooks רשומים"""
-    import json
     redis = request.app.state.redis
     raw   = await redis.get("wa:external_hooks")
-    hooks = json.loads(raw) if raw else []
+    hooks = orjson.loads(raw) if raw else []
     safe  = [{"url": h["url"], "has_secret": bool(h.get("secret"))} for h in hooks]
     return {"webhooks": safe, "count": len(safe)}
 
@@ -275,19 +509,20 @@ async def baileys_event(request: Request):
     - authenticated → שומר creds_b64 + phone ב-Redis
     - הכל → מעביר לכל webhooks חיצוניים
     """
-    import json
-    payload = await request.json()
+    payload = orjson.loads(await request.body())
     redis   = request.app.state.redis
 
-    # שמור creds אם זה אירוע authenticated
+    # שמור creds אם זה אירוע authenticated — פקודת MSET אחת לשני המפתחות
     if payload.get("event") == "authenticated" and payload.get("phone") and payload.get("creds_b64"):
-        await redis.set(f"wa:creds:{payload['phone']}", payload["creds_b64"])
-        await redis.set("wa:last_auth", json.dumps({
-            "phone":     payload["phone"],
-            "jid":       payload.get("jid"),
-            "name":      payload.get("name"),
-            "timestamp": payload.get("timestamp"),
-        }))
+        await redis.mset({
+            f"wa:creds:{payload['phone']}": payload["creds_b64"],
+            "wa:last_auth": orjson.dumps({
+                "phone":     payload["phone"],
+                "jid":       payload.get("jid"),
+                "name":      payload.get("name"),
+                "timestamp": payload.get("timestamp"),
+            }),
+        })
 
     await forward_to_webhooks(redis, payload)
     return {"ok": True}
@@ -297,12 +532,11 @@ async def baileys_event(request: Request):
 @app.get("/auth/status", tags=["Auth"])
 async def auth_status(request: Request):
     """מראה מי מחובר כרגע ומתי התאמת לאחרונה."""
-    import json
     redis = request.app.state.redis
     raw   = await redis.get("wa:last_auth")
     if not raw:
         return {"authenticated": False}
-    info = json.loads(raw)
+    info = orjson.loads(raw)
     return {"authenticated": True, **info}
 
 
@@ -331,12 +565,11 @@ async def get_creds(request: Request, phone: str):
 @app.get("/auth/dashboard", tags=["Auth"])
 async def auth_dashboard(request: Request):
     """דף HTML — מצב אימות + creds_b64"""
-    import json
     from fastapi.responses import HTMLResponse
 
     redis    = request.app.state.redis
     raw      = await redis.get("wa:last_auth")
-    auth     = json.loads(raw) if raw else None
+    auth     = orjson.loads(raw) if raw else None
     creds_b64    = None
     creds_length = 0
     if auth and auth.get("phone"):
@@ -417,25 +650,97 @@ h1{{font-size:1.4rem;margin-bottom:1.5rem;color:#f8fafc}}
 
 # ── Messages ──────────────────────────────────────────────────────────────────
 @app.get("/messages/stream/info", tags=["Messages"])
-async def stream_info():
-    return await baileys_get("/messages/stream/info")
+async def stream_info(request: Request):
+    """מידע על ה-Stream — ישירות מ-Redis"""
+    redis = request.app.state.redis
+    try:
+        info = await redis.xinfo_stream(STREAM_KEY)
+    except aioredis.ResponseError:
+        return ORJSONResponse({"length": 0, "firstEntry": None, "lastEntry": None})
+    first = info.get("first-entry")
+    last  = info.get("last-entry")
+    return ORJSONResponse({
+        "length":     info.get("length", 0),
+        "firstEntry": _stream_entry(*first) if first else None,
+        "lastEntry":  _stream_entry(*last)  if last  else None,
+    })
 
 @app.get("/messages/stream/read", tags=["Messages"])
 async def stream_read(
+    request: Request,
     count: int  = Query(10, ge=1, le=100),
-    lastId: str = Query("0")
+    lastId: str = Query("0", pattern=r"^(\d+(-\d+)?|\$)$")
 ):
-    return await baileys_get(f"/messages/stream/read?count={count}&lastId={lastId}")
+    """קרא הודעות מה-Stream (XREAD ישיר, בלי לעבור דרך Baileys)"""
+    redis   = request.app.state.redis
+    entries = await redis.xread({STREAM_KEY: lastId}, count=count)
+    msgs    = [m for eid, fields in entries[0][1] if (m := _stream_entry(eid, fields))] if entries else []
+    return {"messages": msgs, "count": len(msgs)}
+
+async def _create_stream_group(redis) -> bool:
+    """יוצר את ה-consumer group (ואת ה-Stream אם חסר). False אם כבר קיים."""
+    try:
+        await redis.xgroup_create(STREAM_KEY, STREAM_GROUP, id="$", mkstream=True)
+    except aioredis.ResponseError as e:
+        if "BUSYGROUP" not in str(e):
+            raise
+        return False
+    return True
+
+@app.get("/messages/stream/read_group", tags=["Messages"])
+async def stream_read_group(
+    request: Request,
+    consumer: str = Query(..., description="שם ה-consumer (ייחודי לכל לקוח)"),
+    count: int    = Query(64, ge=1, le=500),
+    id: str       = Query(">", pattern=r"^(>|\d+(-\d+)?)$",
+                          description="'>' להודעות חדשות, '0' (או id) לקריאה חוזרת של ה-pending של ה-consumer")
+):
+    """
+    קרא הודעות חדשות דרך consumer group (XREADGROUP).
+
+    כל הודעה נמסרת ל-consumer אחד בלבד ונשארת pending עד ACK.
+    מומלץ לצבור 32–64 ids ולשלוח אותם יחד ל-/messages/stream/ack.
+    אחרי קריסה — קרא עם id=0 כדי לקבל שוב הודעות שנמסרו ל-consumer ולא אושרו.
+    """
+    redis = request.app.state.redis
+    try:
+        entries = await redis.xreadgroup(STREAM_GROUP, consumer, {STREAM_KEY: id}, count=count)
+    except aioredis.ResponseError:
+        # ה-group נוצר בקריאה הראשונה (או מחדש אם ה-Stream נמחק);
+        # אם הוא כבר קיים — השגיאה היא משהו אחר
+        if not await _create_stream_group(redis):
+            raise
+        entries = await redis.xreadgroup(STREAM_GROUP, consumer, {STREAM_KEY: id}, count=count)
+
+    msgs, bad = [], []
+    for eid, fields in entries[0][1] if entries else []:
+        m = _stream_entry(eid, fields)
+        if m:
+            msgs.append(m)
+        else:
+            bad.append(eid)
+    # entry שאי אפשר לפענח לא יגיע ללקוח — מאשרים אותו כאן כדי שלא יישאר pending לתמיד
+    if bad:
+        await redis.xack(STREAM_KEY, STREAM_GROUP, *bad)
+    return {"messages": msgs, "count": len(msgs)}
+
+@app.post("/messages/stream/ack", tags=["Messages"])
+async def stream_ack(request: Request, b: StreamAck):
+    """אשר קבלת הודעות (XACK אחד לכל ה-ids)"""
+    redis = request.app.state.redis
+    acked = await redis.xack(STREAM_KEY, STREAM_GROUP, *b.ids)
+    return {"acked": acked}
 
 @app.get("/messages/trace/{jid}", tags=["Messages"])
 async def trace_conversation(
+    request: Request,
     jid: str,
     limit: int = Query(100, ge=1, le=500)
 ):
-    try:
-        return await baileys_get(f"/messages/trace/{jid}?limit={limit}")
-    except Exception as e:
-        raise HTTPException(503, f"Baileys unavailable: {e}")
+    """היסטוריית שיחה עם JID — סינון בצד Redis (Lua), מהחדש לישן"""
+    raw  = await request.app.state.trace_jid(keys=[STREAM_KEY], args=[_normalize_jid(jid), limit])
+    msgs = orjson.loads(raw)
+    return ORJSONResponse({"jid": jid, "messages": msgs, "count": len(msgs)})
 
 # ── Contacts ──────────────────────────────────────────────────────────────────
 @app.get("/contacts", tags=["Contacts"])
@@ -443,37 +748,28 @@ async def get_contacts(
     q: str     = Query("", description="חיפוש לפי שם או מספר"),
     limit: int = Query(200, ge=1, le=1000)
 ):
-    return await baileys_get(f"/contacts?q={q}&limit={limit}")
+    return await baileys_get("/contacts", params={"q": q, "limit": limit})
 
 @app.get("/contacts/count", tags=["Contacts"])
 async def contacts_count():
-    return await baileys_get("/debug/contacts-count")
+    return ORJSONResponse(await cached_get("/debug/contacts-count"))
 
 @app.get("/version", tags=["System"])
 async def version():
-    try:
-        r = await baileys_get("/version")
-        return r
-    except Exception as e:
-        raise HTTPException(503, f"Baileys unavailable: {e}")
+    return await baileys_get("/version")
     
     
 # ── Health ────────────────────────────────────────────────────────────────────
 @app.get("/health", tags=["System"])
 async def health():
-    redis_ok = False
-    try:
-        await redis_client.ping()
-        redis_ok = True
-    except Exception:
-        pass
-
-    baileys_ok = False
-    try:
-        await baileys_get("/status")
-        baileys_ok = True
-    except Exception:
-        pass
+    # שתי הבדיקות במקביל — זמן התגובה הוא המקסימום ולא הסכום
+    redis_res, baileys_res = await asyncio.gather(
+        redis_client.ping(),
+        baileys_get("/status"),
+        return_exceptions=True,
+    )
+    redis_ok   = not isinstance(redis_res, BaseException)
+    baileys_ok = not isinstance(baileys_res, BaseException)
 
     return {
         "status":  "healthy" if (redis_ok and baileys_ok) else "degraded",
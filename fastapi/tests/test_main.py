@@ -13,14 +13,19 @@ tests/test_main.py
     pytest tests/test_main.py -v
 """
 
+import asyncio
+import base64
 import json
+import httpx
 import pytest
+import redis.asyncio as aioredis
 from unittest.mock import AsyncMock, patch, MagicMock, call
 from fastapi.testclient import TestClient
 
 import sys, os
 sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "app"))
 
+import main
 from main import app
 
 client = TestClient(app, raise_server_exceptions=False)
@@ -95,12 +100,16 @@ def mock_redis():
     async def fake_set(key, val):
         store[key] = val
 
+    async def fake_mset(mapping):
+        store.update(mapping)
+
     async def fake_ping():
         return True
 
     mock = AsyncMock()
     mock.get  = AsyncMock(side_effect=fake_get)
     mock.set  = AsyncMock(side_effect=fake_set)
+    mock.mset = AsyncMock(side_effect=fake_mset)
     mock.ping = AsyncMock(side_effect=fake_ping)
 
     app.state.redis = mock
@@ -184,12 +193,8 @@ class TestAuthenticatedEventForwarding:
         mock_resp = MagicMock()
         mock_resp.status_code = 200
 
-        with patch("httpx.AsyncClient") as mock_cls:
-            mock_c = AsyncMock()
+        with patch("main.webhook_client") as mock_c:
             mock_c.post          = AsyncMock(return_value=mock_resp)
-            mock_c.__aenter__    = AsyncMock(return_value=mock_c)
-            mock_c.__aexit__     = AsyncMock(return_value=False)
-            mock_cls.return_value = mock_c
 
             client.post("/internal/baileys-event", json=AUTH_EVENT)
 
@@ -203,12 +208,8 @@ class TestAuthenticatedEventForwarding:
         mock_resp = MagicMock()
         mock_resp.status_code = 200
 
-        with patch("httpx.AsyncClient") as mock_cls:
-            mock_c = AsyncMock()
+        with patch("main.webhook_client") as mock_c:
             mock_c.post          = AsyncMock(return_value=mock_resp)
-            mock_c.__aenter__    = AsyncMock(return_value=mock_c)
-            mock_c.__aexit__     = AsyncMock(return_value=False)
-            mock_cls.return_value = mock_c
 
             client.post("/internal/baileys-event", json=AUTH_EVENT)
 
@@ -221,12 +222,8 @@ class TestAuthenticatedEventForwarding:
         mock_resp = MagicMock()
         mock_resp.status_code = 200
 
-        with patch("httpx.AsyncClient") as mock_cls:
-            mock_c = AsyncMock()
+        with patch("main.webhook_client") as mock_c:
             mock_c.post          = AsyncMock(return_value=mock_resp)
-            mock_c.__aenter__    = AsyncMock(return_value=mock_c)
-            mock_c.__aexit__     = AsyncMock(return_value=False)
-            mock_cls.return_value = mock_c
 
             client.post("/internal/baileys-event", json=AUTH_EVENT)
 
@@ -250,12 +247,8 @@ class TestAuthenticatedEventForwarding:
 
     def test_webhook_failure_does_not_crash(self, with_one_webhook):
         """webhook חיצוני שנופל — לא קורס, עדיין מחזיר ok."""
-        with patch("httpx.AsyncClient") as mock_cls:
-            mock_c = AsyncMock()
+        with patch("main.webhook_client") as mock_c:
             mock_c.post          = AsyncMock(side_effect=Exception("timeout"))
-            mock_c.__aenter__    = AsyncMock(return_value=mock_c)
-            mock_c.__aexit__     = AsyncMock(return_value=False)
-            mock_cls.return_value = mock_c
 
             resp = client.post("/internal/baileys-event", json=AUTH_EVENT)
 
@@ -269,12 +262,8 @@ class TestAuthenticatedEventForwarding:
 class TestMessageForwarding:
 
     def test_text_message_forwarded(self, with_one_webhook):
-        with patch("httpx.AsyncClient") as mock_cls:
-            mock_c = AsyncMock()
+        with patch("main.webhook_client") as mock_c:
             mock_c.post          = AsyncMock(return_value=MagicMock(status_code=200))
-            mock_c.__aenter__    = AsyncMock(return_value=mock_c)
-            mock_c.__aexit__     = AsyncMock(return_value=False)
-            mock_cls.return_value = mock_c
 
             client.post("/internal/baileys-event", json=TEXT_MESSAGE)
 
@@ -283,12 +272,8 @@ class TestMessageForwarding:
             assert payload["messageId"] == "msg_123"
 
     def test_image_message_forwarded(self, with_one_webhook):
-        with patch("httpx.AsyncClient") as mock_cls:
-            mock_c = AsyncMock()
+        with patch("main.webhook_client") as mock_c:
             mock_c.post          = AsyncMock(return_value=MagicMock(status_code=200))
-            mock_c.__aenter__    = AsyncMock(return_value=mock_c)
-            mock_c.__aexit__     = AsyncMock(return_value=False)
-            mock_cls.return_value = mock_c
 
             client.post("/internal/baileys-event", json=IMAGE_MESSAGE)
 
@@ -296,12 +281,8 @@ class TestMessageForwarding:
             assert payload["type"] == "image"
 
     def test_group_message_forwarded(self, with_one_webhook):
-        with patch("httpx.AsyncClient") as mock_cls:
-            mock_c = AsyncMock()
+        with patch("main.webhook_client") as mock_c:
             mock_c.post          = AsyncMock(return_value=MagicMock(status_code=200))
-            mock_c.__aenter__    = AsyncMock(return_value=mock_c)
-            mock_c.__aexit__     = AsyncMock(return_value=False)
-            mock_cls.return_value = mock_c
 
             client.post("/internal/baileys-event", json=GROUP_MESSAGE)
 
@@ -309,12 +290,8 @@ class TestMessageForwarding:
             assert payload["isGroup"] is True
 
     def test_my_own_message_forwarded(self, with_one_webhook):
-        with patch("httpx.AsyncClient") as mock_cls:
-            mock_c = AsyncMock()
+        with patch("main.webhook_client") as mock_c:
             mock_c.post          = AsyncMock(return_value=MagicMock(status_code=200))
-            mock_c.__aenter__    = AsyncMock(return_value=mock_c)
-            mock_c.__aexit__     = AsyncMock(return_value=False)
-            mock_cls.return_value = mock_c
 
             client.post("/internal/baileys-event", json=MY_MESSAGE)
 
@@ -414,4 +391,440 @@ class TestWebhookManagement:
         items = resp.json()["webhooks"]
         assert items[0]["has_secret"] is True
         assert items[1]["has_secret"] is False
-        assert "topsecret" not in resp.text
\ No newline at end of file
+        assert "topsecret" not in resp.text
+
+# ══════════════════════════════════════════════════════════════════════════════
+# 6. Stream — קריאה ישירה מ-Redis
+# ══════════════════════════════════════════════════════════════════════════════
+
+class TestStreamRead:
+
+    def test_stream_read_flattens_entries(self, mock_redis):
+        mock, _ = mock_redis
+        mock.xread = AsyncMock(return_value=[
+            ["whatsapp:messages", [
+                ("1-0", {"data": json.dumps(TEXT_MESSAGE)}),
+                ("2-0", {"data": "not json"}),
+            ]],
+        ])
+
+        resp = client.get("/messages/stream/read?count=5&lastId=0")
+
+        assert resp.json()["count"] == 1
+        msg = resp.json()["messages"][0]
+        assert msg["id"]        == "1-0"
+        assert msg["messageId"] == "msg_123"
+        mock.xread.assert_awaited_once_with({"whatsapp:messages": "0"}, count=5)
+
+    def test_stream_read_skips_non_object_data(self, mock_redis):
+        mock, _ = mock_redis
+        mock.xread = AsyncMock(return_value=[
+            ["whatsapp:messages", [("1-0", {"data": "[1]"}), ("2-0", {"data": "7"})]],
+        ])
+
+        resp = client.get("/messages/stream/read")
+
+        assert resp.status_code == 200
+        assert resp.json() == {"messages": [], "count": 0}
+
+    def test_stream_read_rejects_bad_last_id(self, mock_redis):
+        mock, _ = mock_redis
+        mock.xread = AsyncMock(return_value=[])
+
+        resp = client.get("/messages/stream/read?lastId=abc")
+
+        assert resp.status_code == 422
+        mock.xread.assert_not_awaited()
+
+    def test_stream_read_empty(self, mock_redis):
+        mock, _ = mock_redis
+        mock.xread = AsyncMock(return_value=[])
+
+        resp = client.get("/messages/stream/read")
+
+        assert resp.json() == {"messages": [], "count": 0}
+
+    def test_stream_info(self, mock_redis):
+        mock, _ = mock_redis
+        mock.xinfo_stream = AsyncMock(return_value={
+            "length":      2,
+            "first-entry": ("1-0", {"data": json.dumps(TEXT_MESSAGE)}),
+            "last-entry":  ("2-0", {"data": json.dumps(IMAGE_MESSAGE)}),
+        })
+
+        body = client.get("/messages/stream/info").json()
+
+        assert body["length"] == 2
+        assert body["firstEntry"]["id"]        == "1-0"
+        assert body["lastEntry"]["messageId"]  == "msg_456"
+
+    def test_stream_read_group(self, mock_redis):
+        mock, _ = mock_redis
+        mock.xreadgroup = AsyncMock(return_value=[
+            ["whatsapp:messages", [("1-0", {"data": json.dumps(TEXT_MESSAGE)})]],
+        ])
+
+        resp = client.get("/messages/stream/read_group?consumer=worker-1&count=32")
+
+        assert resp.json()["messages"][0]["id"] == "1-0"
+        mock.xreadgroup.assert_awaited_once_with(
+            "api-consumers", "worker-1", {"whatsapp:messages": ">"}, count=32
+        )
+
+    def test_trace_uses_redis_script(self, mock_redis):
+        script = AsyncMock(return_value=json.dumps([{"id": "1-0", **TEXT_MESSAGE}]))
+        app.state.trace_jid = script
+
+        body = client.get(f"/messages/trace/{PHONE}?limit=20").json()
+
+        assert body["jid"]   == PHONE
+        assert body["count"] == 1
+        assert body["messages"][0]["messageId"] == "msg_123"
+        script.assert_awaited_once_with(keys=["whatsapp:messages"], args=[JID, 20])
+
+    def test_stream_read_group_creates_missing_group(self, mock_redis):
+        mock, _ = mock_redis
+        mock.xreadgroup = AsyncMock(side_effect=[
+            aioredis.ResponseError("NOGROUP No such key 'whatsapp:messages'"),
+            [],
+        ])
+        mock.xgroup_create = AsyncMock(return_value=True)
+
+        resp = client.get("/messages/stream/read_group?consumer=worker-1")
+
+        assert resp.json() == {"messages": [], "count": 0}
+        mock.xgroup_create.assert_awaited_once_with(
+            "whatsapp:messages", "api-consumers", id="$", mkstream=True
+        )
+        assert mock.xreadgroup.await_count == 2
+
+    def test_stream_read_group_acks_undecodable(self, mock_redis):
+        mock, _ = mock_redis
+        mock.xreadgroup = AsyncMock(return_value=[
+            ["whatsapp:messages", [
+                ("1-0", {"data": json.dumps(TEXT_MESSAGE)}),
+                ("2-0", {"data": "not json"}),
+            ]],
+        ])
+        mock.xack = AsyncMock(return_value=1)
+
+        resp = client.get("/messages/stream/read_group?consumer=worker-1")
+
+        assert [m["id"] for m in resp.json()["messages"]] == ["1-0"]
+        mock.xack.assert_awaited_once_with("whatsapp:messages", "api-consumers", "2-0")
+
+    def test_stream_read_group_rereads_pending(self, mock_redis):
+        mock, _ = mock_redis
+        mock.xreadgroup = AsyncMock(return_value=[
+            ["whatsapp:messages", [
+                ("1-0", {"data": json.dumps(TEXT_MESSAGE)}),
+                ("2-0", None),
+            ]],
+        ])
+        mock.xack = AsyncMock(return_value=1)
+
+        resp = client.get("/messages/stream/read_group?consumer=worker-1&id=0")
+
+        assert [m["id"] for m in resp.json()["messages"]] == ["1-0"]
+        mock.xreadgroup.assert_awaited_once_with(
+            "api-consumers", "worker-1", {"whatsapp:messages": "0"}, count=64
+        )
+        # entry שנמחק מה-Stream מאושר כדי שלא יחזור שוב
+        mock.xack.assert_awaited_once_with("whatsapp:messages", "api-consumers", "2-0")
+
+    def test_stream_read_group_rejects_bad_id(self, mock_redis):
+        resp = client.get("/messages/stream/read_group?consumer=worker-1&id=$")
+        assert resp.status_code == 422
+
+    def test_stream_ack_batches_ids(self, mock_redis):
+        mock, _ = mock_redis
+        mock.xack = AsyncMock(return_value=2)
+
+        resp = client.post("/messages/stream/ack", json={"ids": ["1-0", "2-0"]})
+
+        assert resp.json() == {"acked": 2}
+        mock.xack.assert_awaited_once_with("whatsapp:messages", "api-consumers", "1-0", "2-0")
+
+
+# ══════════════════════════════════════════════════════════════════════════════
+# 7. Contacts — פרמטרים מקודדים ל-Baileys
+# ══════════════════════════════════════════════════════════════════════════════
+
+class TestContacts:
+
+    def test_contacts_query_passed_as_params(self, mock_redis):
+        with patch("main.baileys_get", new=AsyncMock(return_value={"count": 0, "items": []})) as m:
+            client.get("/contacts", params={"q": "a&b c", "limit": 5})
+
+        m.assert_awaited_once_with("/contacts", params={"q": "a&b c", "limit": 5})
+
+    def test_contacts_count_cached(self, mock_redis):
+        main._get_cache.clear()
+        with patch("main.baileys_get", new=AsyncMock(return_value={"count": 7})) as m:
+            first  = client.get("/contacts/count")
+            second = client.get("/contacts/count")
+
+        assert first.json() == second.json() == {"count": 7}
+        m.assert_awaited_once_with("/debug/contacts-count")
+
+    def test_cached_get_single_flight_on_failure(self, mock_redis):
+        main._get_cache.clear()
+
+        async def failing(path):
+            await asyncio.sleep(0.05)
+            raise httpx.ConnectError("refused")
+
+        async def run():
+            return await asyncio.gather(
+                *(main.cached_get("/status") for _ in range(5)),
+                return_exceptions=True,
+            )
+
+        with patch("main.baileys_get", new=AsyncMock(side_effect=failing)) as m:
+            results = asyncio.run(run())
+
+        # 5 קוראים במקביל → קריאה אחת ל-Baileys, וכולם מקבלים את השגיאה
+        assert m.await_count == 1
+        assert all(isinstance(r, httpx.ConnectError) for r in results)
+        assert not main._get_inflight
+
+
+# ══════════════════════════════════════════════════════════════════════════════
+# 8. Webhooks במנות (batched)
+# ══════════════════════════════════════════════════════════════════════════════
+
+class TestBatchedWebhooks:
+
+    def test_register_batched_stores_settings(self, mock_redis):
+        _, store = mock_redis
+        with patch("main.baileys_post", new=AsyncMock()) as post:
+            resp = client.post("/webhooks/register_batched",
+                               json={"url": WEBHOOK_URL, "batchSize": 2})
+
+        assert resp.json()["success"] is True
+        saved = json.loads(store["wa:external_hooks"])
+        assert saved[0]["batchSize"]       == 2
+        assert saved[0]["batchIntervalMs"] == 200
+        # Baileys לא מקבל את ה-url — אחרת היה שולח כל אירוע פעמיים
+        post.assert_not_awaited()
+
+    def test_register_batched_removes_plain_hook_from_baileys(self, mock_redis):
+        _, store = mock_redis
+        store["wa:external_hooks"] = json.dumps([{"url": WEBHOOK_URL, "secret": None}])
+
+        with patch("main.baileys_delete", new=AsyncMock(return_value={"success": True})) as delete:
+            client.post("/webhooks/register_batched", json={"url": WEBHOOK_URL})
+
+        delete.assert_awaited_once_with("/webhooks/unregister", {"url": WEBHOOK_URL})
+        saved = json.loads(store["wa:external_hooks"])
+        assert len(saved) == 1 and saved[0]["batchSize"] == 50
+
+    def test_batched_webhook_receives_array(self, mock_redis):
+        mock, store = mock_redis
+        store["wa:external_hooks"] = json.dumps([
+            {"url": WEBHOOK_URL,  "secret": None, "batchSize": 2, "batchIntervalMs": 60000},
+            {"url": WEBHOOK_URL2, "secret": None},
+        ])
+        batches = []
+
+        singles = []
+
+        with patch("main.webhook_client") as mock_c:
+            async def run():
+                release = asyncio.Event()
+
+                async def post(url, json, headers):
+                    if url == WEBHOOK_URL2:
+                        singles.append(json)
+                        return
+                    await release.wait()
+                    batches.append((url, json))
+                mock_c.post = post
+
+                await main.forward_to_webhooks(mock, TEXT_MESSAGE)
+                await main.forward_to_webhooks(mock, IMAGE_MESSAGE)
+                # המנה המלאה נשלחת ברקע — webhook רגיל לא מחכה לה
+                assert singles == [TEXT_MESSAGE, IMAGE_MESSAGE]
+                assert batches == []
+
+                release.set()
+                await main.flush_webhook_batches()
+            asyncio.run(run())
+
+        assert batches == [(WEBHOOK_URL, [TEXT_MESSAGE, IMAGE_MESSAGE])]
+        assert not main._webhook_timers
+        assert not main._webhook_sends
+
+    def test_register_plain_replaces_batched_hook(self, mock_redis):
+        _, store = mock_redis
+        store["wa:external_hooks"] = json.dumps([
+            {"url": WEBHOOK_URL, "secret": None, "batchSize": 50, "batchIntervalMs": 200},
+        ])
+        main._webhook_batches[WEBHOOK_URL] = ({"url": WEBHOOK_URL}, [TEXT_MESSAGE])
+
+        with patch("main.baileys_post", new=AsyncMock(return_value={"success": True})):
+            client.post("/webhooks/register", json={"url": WEBHOOK_URL})
+
+        saved = json.loads(store["wa:external_hooks"])
+        assert saved == [{"url": WEBHOOK_URL, "secret": None}]
+        assert WEBHOOK_URL not in main._webhook_batches
+
+    def test_unregister_drops_pending_batch(self, mock_redis):
+        _, store = mock_redis
+        store["wa:external_hooks"] = json.dumps([
+            {"url": WEBHOOK_URL, "secret": None, "batchSize": 50, "batchIntervalMs": 200},
+        ])
+        main._webhook_batches[WEBHOOK_URL] = ({"url": WEBHOOK_URL}, [TEXT_MESSAGE])
+
+        with patch("main.baileys_delete", new=AsyncMock(return_value={"success": True})):
+            client.request("DELETE", "/webhooks/unregister", json={"url": WEBHOOK_URL})
+
+        assert WEBHOOK_URL not in main._webhook_batches
+
+    def test_timer_flush_awaited_on_shutdown(self, mock_redis):
+        wh = {"url": WEBHOOK_URL, "secret": None, "batchSize": 50, "batchIntervalMs": 10}
+        batches = []
+
+        async def slow_post(url, json, headers):
+            await asyncio.sleep(0.05)
+            batches.append((url, json))
+
+        async def run():
+            main._enqueue_batched(wh, TEXT_MESSAGE)
+            await asyncio.sleep(0.02)          # הטיימר יורה, ה-POST עדיין באוויר
+            assert not main._webhook_batches
+            await main.flush_webhook_batches()
+
+        with patch("main.webhook_client") as wh_client:
+            wh_client.post = slow_post
+            asyncio.run(run())
+
+        assert batches == [(WEBHOOK_URL, [TEXT_MESSAGE])]
+
+
+# ══════════════════════════════════════════════════════════════════════════════
+# 9. QR Code
+# ══════════════════════════════════════════════════════════════════════════════
+
+class TestQRCode:
+
+    def test_qrcode_image_is_png_with_length(self, mock_redis):
+        with patch("main.baileys_get", new=AsyncMock(return_value={"qr": "2@abc", "status": "qr"})):
+            resp = client.get("/qrcode/image")
+
+        assert resp.status_code == 200
+        assert resp.content.startswith(b"\x89PNG")
+        assert int(resp.headers["content-length"]) == len(resp.content)
+
+    def test_qrcode_json_matches_image(self, mock_redis):
+        with patch("main.baileys_get", new=AsyncMock(return_value={"qr": "2@abc", "status": "qr"})):
+            img  = client.get("/qrcode/image").content
+            body = client.get("/qrcode").json()
+
+        assert base64.b64decode(body["qr_image_base64"]) == img
+
+
+# ══════════════════════════════════════════════════════════════════════════════
+# 10. שגיאות Baileys → HTTP
+# ══════════════════════════════════════════════════════════════════════════════
+
+class TestBaileysErrors:
+
+    def test_baileys_down_returns_503(self, mock_redis):
+        with patch("main.baileys_get", new=AsyncMock(side_effect=httpx.ConnectError("refused"))):
+            resp = client.get("/version")
+
+        assert resp.status_code == 503
+        assert "Baileys unavailable" in resp.json()["detail"]
+
+    def test_baileys_404_passed_through(self, mock_redis):
+        req = httpx.Request("GET", "http://baileys/qrcode")
+        err = httpx.HTTPStatusError(
+            "404", request=req,
+            response=httpx.Response(404, json={"error": "QR not available"}, request=req),
+        )
+        with patch("main.baileys_get", new=AsyncMock(side_effect=err)):
+            resp = client.get("/qrcode")
+
+        assert resp.status_code == 404
+        assert resp.json()["detail"] == "QR not available"
+
+    def test_baileys_4xx_passed_through(self, mock_redis):
+        req = httpx.Request("POST", "http://baileys/send/text")
+        err = httpx.HTTPStatusError(
+            "400", request=req,
+            response=httpx.Response(400, json={"error": "bad jid"}, request=req),
+        )
+        with patch("main.baileys_post_raw", new=AsyncMock(side_effect=err)):
+            resp = client.post("/send/text", json={"jid": "x", "text": "hi"})
+
+        assert resp.status_code == 400
+        assert resp.json()["detail"] == "bad jid"
+
+    def test_baileys_5xx_returns_503(self, mock_redis):
+        req = httpx.Request("POST", "http://baileys/send/text")
+        err = httpx.HTTPStatusError(
+            "500", request=req,
+            response=httpx.Response(500, json={"error": "socket closed"}, request=req),
+        )
+        with patch("main.baileys_post_raw", new=AsyncMock(side_effect=err)):
+            resp = client.post("/send/text", json={"jid": "x", "text": "hi"})
+
+        assert resp.status_code == 503
+
+    def test_baileys_non_json_body_returns_503(self, mock_redis):
+        old = main.http_client
+        main.http_client = httpx.AsyncClient(
+            base_url="http://baileys",
+            transport=httpx.MockTransport(lambda req: httpx.Response(200, text="<html>Bad Gateway</html>")),
+        )
+        try:
+            resp = client.get("/version")
+        finally:
+            main.http_client = old
+
+        assert resp.status_code == 503
+        assert "invalid JSON" in resp.json()["detail"]
+
+
+# ══════════════════════════════════════════════════════════════════════════════
+# 11. Send — גוף הבקשה ל-Baileys
+# ══════════════════════════════════════════════════════════════════════════════
+
+class TestSend:
+
+    def test_send_list_body_matches_model_dump(self, mock_redis):
+        seen = {}
+
+        def handler(req: httpx.Request) -> httpx.Response:
+            seen["path"]         = req.url.path
+            seen["content_type"] = req.headers["content-type"]
+            seen["body"]         = json.loads(req.content)
+            return httpx.Response(200, json={"success": True})
+
+        body = {
+            "jid": JID,
+            "text": "בחר שירות:",
+            "sections": [{
+                "title": "שירותים",
+                "rows": [
+                    {"id": "s1", "title": "שירות 1", "description": "תיאור"},
+                    {"id": "s2", "title": "שירות 2"},
+                ],
+            }],
+        }
+        old = main.http_client
+        main.http_client = httpx.AsyncClient(
+            base_url="http://baileys", transport=httpx.MockTransport(handler)
+        )
+        try:
+            resp = client.post("/send/list", json=body)
+        finally:
+            main.http_client = old
+
+        assert resp.json() == {"success": True}
+        assert seen["path"]         == "/send/list"
+        assert seen["content_type"] == "application/json"
+        assert seen["body"]         == main.ListMsg(**body).model_dump()
+        assert seen["body"]["title"] is None
+        assert seen["body"]["sections"][0]["rows"][1]["description"] is None